@@ -0,0 +1,17 @@
+# Gunicorn settings for production, picked up automatically by `gunicorn main:app`
+# when started from this directory
+import multiprocessing
+import os
+
+# Uvicorn workers use uvloop and httptools when they are installed
+worker_class = "uvicorn.workers.UvicornWorker"
+# Each worker keeps its own response cache of up to AUDIO_CACHE_BYTES (16 MiB by
+# default) and admits up to MAX_CONCURRENCY requests to Cloud Run, so size them together
+workers = int(os.getenv("WEB_CONCURRENCY", 2 * multiprocessing.cpu_count() + 1))
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# Keep client connections open between requests
+keepalive = 75
+
+# No per-request access log on the hot path; errors are still logged
+accesslog = None
@@ -1,84 +1,386 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+from cachetools import LRUCache
+import asyncio
+import hashlib
 import httpx
-import io
 import logging
+import logging.handlers
+import os
+import queue
+import sys
 from pathlib import Path
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging: records go through a queue and are written to stderr by a
+# background listener thread, so request handlers never block on the write
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    handlers=[logging.handlers.QueueHandler(log_queue)],
+)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Talking Agent Proxy")
+# Maximum number of conversation requests forwarded to Cloud Run at once, per worker
+# process; the bound on Cloud Run is this multiplied by the number of workers
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "32"))
+
+class ConcurrencyLimiter:
+    """Admission control: callers wait until fewer than `limit` requests are in flight."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.inflight = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.inflight < self.limit)
+            self.inflight += 1
+
+    async def release(self):
+        async with self._cond:
+            self.inflight -= 1
+            self._cond.notify(1)
+
+async def warm_up_upstream(client: httpx.AsyncClient):
+    """Open the pooled connection to Cloud Run (and wake the service) before the first real request."""
+    try:
+        await client.get(CLOUD_RUN_TEST_URL)
+    except httpx.HTTPError as e:
+        logger.warning("Cloud Run warm-up failed: %s", e)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create one pooled HTTP/2 client for Cloud Run and reuse it for every request."""
+    log_listener.start()
+    app.state.limiter = ConcurrencyLimiter(MAX_CONCURRENCY)
+    app.state.client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(30.0, connect=5.0),
+        # Keep idle connections open between bursts instead of httpx's 5s default
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0),
+    )
+    # Warm up in the background so startup is not held up by a cold Cloud Run instance
+    warm_up = asyncio.create_task(warm_up_upstream(app.state.client))
+    yield
+    warm_up.cancel()
+    await app.state.client.aclose()
+    log_listener.stop()
+
+app = FastAPI(title="Talking Agent Proxy", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Largest audio upload accepted, in bytes
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+
+# Room for the multipart boundary and part headers around the audio in the request body
+UPLOAD_FORM_OVERHEAD = 16 * 1024
+
+class UploadTooLarge(Exception):
+    """Raised from the wrapped receive() once a conversation upload passes the size limit."""
+
+class UploadSizeLimit:
+    """Reject conversation uploads over the limit at the ASGI layer, before they are spooled.
+
+    FastAPI receives and spools the whole multipart body before the endpoint runs, so the
+    declared Content-Length is checked up front and, for chunked or HTTP/2 uploads without
+    one, body bytes are counted as they arrive.
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def reject(self, scope, receive, send):
+        response = ORJSONResponse(status_code=413, content={"detail": f"Audio upload exceeds {MAX_UPLOAD_BYTES} bytes"})
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != "/api/conversation":
+            await self.app(scope, receive, send)
+            return
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > self.max_bytes:
+                await self.reject(scope, receive, send)
+                return
+
+        received = 0
+        too_large = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    too_large = True
+                    raise UploadTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            # FastAPI turns the receive error into a 400; replace it with the 413 below
+            if too_large and not response_started:
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except UploadTooLarge:
+            pass
+        if too_large and not response_started:
+            await self.reject(scope, receive, send)
+
+# Added before CORSMiddleware so its 413 responses still carry CORS headers
+app.add_middleware(UploadSizeLimit, max_bytes=MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD)
+
+# Allow CORS if your front-end is served from a different domain. For production,
+# set FRONTEND_ORIGINS to a comma-separated list of your front-end URLs.
+FRONTEND_ORIGINS = [origin.strip() for origin in os.getenv("FRONTEND_ORIGINS", "*").split(",") if origin.strip()]
 
-# Allow CORS if your front-end is served from a different domain
+# The front end sends no cookies or auth headers, so credentials stay disabled; with
+# the default "*" origin this lets CORSMiddleware use fixed headers without echoing Origin
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # For production, restrict this to your front-end URL
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=FRONTEND_ORIGINS,
+    allow_credentials=False,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type"],
+    max_age=86400,  # Let browsers cache preflight responses for a day
 )
 
+# Browser cache lifetime for static assets, in seconds
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "3600"))
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that lets browsers cache assets instead of re-fetching them from the app."""
+
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        response.headers["Cache-Control"] = f"public, max-age={STATIC_MAX_AGE}"
+        return response
+
 # Mount static files (e.g., index.html, script.js, custom CSS)
 static_dir = Path(__file__).parent / "static"
-app.mount("/static", StaticFiles(directory=static_dir), name="static")
+app.mount("/static", CachedStaticFiles(directory=static_dir), name="static")
 
 # Cloud Run service endpoint URL (replace with your actual Cloud Run URL)
 CLOUD_RUN_URL = "https://audio-processing-service-490280071789.us-east1.run.app"
+# Assuming the Cloud Run service has a /api/test endpoint; adjust if needed.
+CLOUD_RUN_TEST_URL = CLOUD_RUN_URL.replace("/api/conversation", "/api/test")
+
+# Audio content types accepted for forwarding to Cloud Run
+ALLOWED_CONTENT_TYPES = frozenset({"audio/wav", "audio/wave", "audio/x-wav", "audio/webm", "audio/ogg", "audio/mpeg"})
+
+# File extensions for the audio formats the Cloud Run service may return
+AUDIO_EXTENSIONS = {"audio/wav": "wav", "audio/x-wav": "wav", "audio/ogg": "ogg", "audio/mpeg": "mp3"}
+
+# Content-Disposition header values per audio format, built once at import
+AUDIO_DISPOSITIONS = {
+    media_type: f"inline; filename=response.{extension}" for media_type, extension in AUDIO_EXTENSIONS.items()
+}
+
+# Size of the chunks relayed from the Cloud Run response to the client
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Responses for recently seen audio, keyed by a digest of the uploaded bytes and
+# bounded by total body size (AUDIO_CACHE_BYTES=0 disables the cache). The bound is
+# per process, so the total is multiplied by the number of workers.
+audio_cache = LRUCache(
+    maxsize=int(os.getenv("AUDIO_CACHE_BYTES", str(16 * 1024 * 1024))),
+    getsizeof=lambda entry: len(entry[0]),
+)
+
+async def audio_digest(audio: UploadFile) -> bytes:
+    """Hash the uploaded audio in chunks and rewind it so it can still be forwarded."""
+    digest = hashlib.blake2b(digest_size=16)
+    while chunk := await audio.read(STREAM_CHUNK_SIZE):
+        digest.update(chunk)
+    await audio.seek(0)
+    return digest.digest()
+
+def multipart_upload(audio: UploadFile):
+    """Build headers and an async multipart/form-data body that reads the upload in chunks.
+
+    Handing UploadFile.file to httpx makes it call fileno() to measure the part, which
+    forces an in-memory upload to roll over to a temp file on disk on every request.
+    """
+    boundary = os.urandom(16).hex()
+    filename = (audio.filename or "audio").replace("\\", "\\\\").replace('"', "%22").replace("\r", "").replace("\n", "")
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="audio"; filename="{filename}"\r\n'
+        f"Content-Type: {audio.content_type}\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    headers = {
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Length": str(len(head) + audio.size + len(tail)),
+    }
+
+    async def body():
+        yield head
+        while chunk := await audio.read(STREAM_CHUNK_SIZE):
+            yield chunk
+        yield tail
+
+    return headers, body()
+
+@app.exception_handler(Exception)
+async def unhandled_error(request, exc):
+    """Fallback for errors the endpoints do not handle themselves; the server logs the traceback.
+
+    This handler runs in ServerErrorMiddleware, outside CORSMiddleware, so it adds the CORS
+    headers itself to keep the JSON body readable by cross-origin front ends.
+    """
+    headers = {}
+    origin = request.headers.get("origin")
+    if "*" in FRONTEND_ORIGINS:
+        headers["Access-Control-Allow-Origin"] = "*"
+    elif origin in FRONTEND_ORIGINS:
+        headers["Access-Control-Allow-Origin"] = origin
+        headers["Vary"] = "Origin"
+    return ORJSONResponse(status_code=500, content={"detail": "Error processing request"}, headers=headers)
 
 @app.get("/api/test")
 async def test():
     """Test endpoint to ensure connectivity to the Cloud Run service."""
     try:
         # Forward a test request to Cloud Run's /api/test endpoint (if available)
-        async with httpx.AsyncClient() as client:
-            # Assuming the Cloud Run service has a /api/test endpoint; adjust if needed.
-            response = await client.get(CLOUD_RUN_URL.replace("/api/conversation", "/api/test"))
-            if response.status_code == 200:
-                return {"status": "ok", "message": "Proxy and Cloud Run service are operational"}
-            else:
-                return JSONResponse(status_code=response.status_code, content={"detail": "Cloud Run test failed"})
-    except Exception as e:
-        logger.error(f"Error in test endpoint: {str(e)}")
-        return JSONResponse(status_code=500, content={"detail": str(e)})
+        response = await app.state.client.get(CLOUD_RUN_TEST_URL)
+    except httpx.HTTPError as e:
+        logger.error("Error in test endpoint: %s", e)
+        return ORJSONResponse(status_code=502, content={"detail": "Cloud Run service unreachable"})
+    if response.status_code == 200:
+        return {"status": "ok", "message": "Proxy and Cloud Run service are operational"}
+    else:
+        return ORJSONResponse(status_code=response.status_code, content={"detail": "Cloud Run test failed"})
 
 @app.post("/api/conversation")
 async def conversation(audio: UploadFile = File(...)):
     """Proxy endpoint: forwards audio file to the Cloud Run audio processing service and streams back the audio response."""
+    # Reject unsupported or oversized uploads before paying for a round trip to Cloud Run
+    content_type = (audio.content_type or "").partition(";")[0].strip().lower()
+    if content_type not in ALLOWED_CONTENT_TYPES:
+        return ORJSONResponse(status_code=415, content={"detail": f"Unsupported audio type: {audio.content_type}"})
+    if audio.size > MAX_UPLOAD_BYTES:
+        return ORJSONResponse(status_code=413, content={"detail": f"Audio upload exceeds {MAX_UPLOAD_BYTES} bytes"})
+    
+    # Identical audio (e.g. client retries) is answered without calling Cloud Run again
+    cache_key = await audio_digest(audio)
+    cached = audio_cache.get(cache_key)
+    if cached is not None:
+        body, media_type = cached
+        logger.info("Proxy cache hit for audio: %s", audio.filename)
+        return Response(
+            content=body,
+            media_type=media_type,
+            headers={"Content-Disposition": AUDIO_DISPOSITIONS[media_type]}
+        )
+    
+    # Wait for a free slot so bursts cannot overload the Cloud Run service
+    limiter = app.state.limiter
+    await limiter.acquire()
+    slot_handed_off = False
     try:
-        # Read the audio file from the client
-        audio_data = await audio.read()
-        logger.info(f"Proxy received audio: {audio.filename}, size: {len(audio_data)} bytes")
+        logger.info("Proxy received audio: %s, size: %s bytes", audio.filename, audio.size)
         
-        # Prepare the file payload for the Cloud Run service
-        files = {"audio": (audio.filename, audio_data, audio.content_type)}
+        # Stream the upload to Cloud Run in chunks rather than holding a full copy in memory
+        headers, content = multipart_upload(audio)
         
-        # Forward the audio file using an asynchronous HTTP client
-        async with httpx.AsyncClient() as client:
-            response = await client.post(CLOUD_RUN_URL, files=files)
+        # Forward the audio file and stream the response back as it arrives,
+        # instead of buffering the whole body in memory first
+        client = app.state.client
+        request = client.build_request("POST", CLOUD_RUN_URL, headers=headers, content=content)
+        try:
+            response = await client.send(request, stream=True)
+        except httpx.TimeoutException as e:
+            logger.error("Cloud Run request timed out: %s", e)
+            return ORJSONResponse(status_code=504, content={"detail": "Cloud Run service timed out"})
+        except httpx.HTTPError as e:
+            logger.error("Proxy error: %s", e)
+            return ORJSONResponse(status_code=502, content={"detail": "Cloud Run service unreachable"})
         
         if response.status_code != 200:
-            logger.error(f"Cloud Run service error: {response.status_code}")
-            return JSONResponse(status_code=response.status_code, content={"detail": "Error from Cloud Run service"})
+            logger.error("Cloud Run service error: %d", response.status_code)
+            await response.aclose()
+            return ORJSONResponse(status_code=response.status_code, content={"detail": "Error from Cloud Run service"})
+        
+        # Relay the upstream audio format so compressed encodings (OGG/Opus, MP3)
+        # reach the browser labelled correctly; fall back to WAV
+        media_type = response.headers.get("content-type", "").partition(";")[0].strip().lower()
+        if media_type not in AUDIO_DISPOSITIONS:
+            media_type = "audio/wav"
+        
+        released = False
+        
+        async def release_upstream():
+            # Idempotent: runs from the stream's finally (upstream errors mid-stream, which
+            # skip Starlette's background task) and as the background task (client gone
+            # before the stream was iterated), so the connection and slot are returned once
+            nonlocal released
+            if released:
+                return
+            try:
+                await response.aclose()
+            finally:
+                await limiter.release()
+                released = True
+        
+        async def stream_audio():
+            # Keep a copy for the cache only while the body can still fit in it, so
+            # large responses (or a disabled cache) stay O(chunk) in memory
+            chunks = []
+            size = 0
+            cacheable = audio_cache.maxsize > 0
+            try:
+                async for chunk in response.aiter_bytes(chunk_size=STREAM_CHUNK_SIZE):
+                    if cacheable:
+                        size += len(chunk)
+                        if size <= audio_cache.maxsize:
+                            chunks.append(chunk)
+                        else:
+                            cacheable = False
+                            chunks.clear()
+                    yield chunk
+                # Only cache bodies that were relayed completely
+                if cacheable:
+                    audio_cache[cache_key] = (b"".join(chunks), media_type)
+            finally:
+                await release_upstream()
         
-        # Stream the returned audio content to the client
+        slot_handed_off = True
         return StreamingResponse(
-            io.BytesIO(response.content),
-            media_type="audio/wav",
-            headers={"Content-Disposition": "inline; filename=response.wav"}
+            stream_audio(),
+            media_type=media_type,
+            headers={"Content-Disposition": AUDIO_DISPOSITIONS[media_type]},
+            background=BackgroundTask(release_upstream),
         )
     
-    except Exception as e:
-        logger.error(f"Proxy error: {str(e)}")
-        return JSONResponse(status_code=500, content={"detail": f"Error processing request: {str(e)}"})
+    finally:
+        if not slot_handed_off:
+            await limiter.release()
 
 @app.get("/")
 async def serve_index():
-    return FileResponse(static_dir / "index.html")
+    # Always revalidate the page itself so asset changes are picked up
+    return FileResponse(static_dir / "index.html", headers={"Cache-Control": "no-cache"})
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        # uvloop is not available on Windows
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        log_level="warning",
+    )